@@ -12,23 +12,29 @@ class Agent(object):
         self.eps = eps
         self.mode = mode
         self.name = name
+        # cumulative policy for sampling without an action mask,
+        # a snapshot of Q: create a new Agent if Q is modified in place
+        self.cumQ = np.cumsum(Q, -1) if Q is not None and mode == 'prob' else None
 
     def step(self, state, nA=None, Amask=None):
         if nA is None:
             nA = self.Q[state].shape[-1]
-        if Amask is None:
-            Amask = np.ones(nA)
         if self.Q is None:
             A = np.random.randint(0, nA)
         else:
             if self.mode=='prob':
-                p = self.Q[state]*Amask
-                if p.sum()>0:
-                    try:
-                        A = np.random.choice(nA, p=p/p.sum())
-                    except ValueError as e:
-                        raise Exception(f"{e}\n sum p ={p.sum()}, p={p} @ S={state}")
+                if Amask is None:
+                    cum = self.cumQ[state]
                 else:
+                    cum = np.cumsum(self.Q[state]*Amask)
+                p = np.diff(cum, prepend=0)
+                if np.any(p < 0):
+                    raise Exception(f"probabilities are not non-negative\n sum p ={cum[-1]}, p={p} @ S={state}")
+                if cum[-1]>0:
+                    A = np.searchsorted(cum, np.random.random()*cum[-1], side='right')
+                else:
+                    if Amask is None:
+                        Amask = np.ones(nA)
                     A = np.random.choice(np.arange(nA)[Amask.astype(bool)])
             elif self.mode == 'argmax':
                 A = epsilon_greedy_policy(self.Q, 0, state, nA)
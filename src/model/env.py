@@ -3,6 +3,7 @@ Environment wrapper for agent training
 rlsn 2024
 """
 import numpy as np
+import itertools
 import gymnasium as gym  ### pip install gymnasium
 from gymnasium import spaces
 from src.model.agent import Agent
@@ -15,15 +16,37 @@ class Rule(object):
         self.n_max_actions = 1 + self.level * 2  # 1 yun + n attack + n defense
         self.init_energy = init_energy
 
+        # decoded (yun, attack, defense) of each action id
+        self._yun = np.zeros(self.n_max_actions, dtype=np.intp)
+        self._yun[0] = 1
+        self._atk = np.zeros(self.n_max_actions, dtype=np.intp)
+        self._atk[1:self.level + 1] = np.arange(1, self.level + 1)
+        self._def = np.zeros(self.n_max_actions, dtype=np.intp)
+        self._def[self.level + 1:] = np.arange(1, self.level + 1)
+        self._decoded = list(zip(self._yun.tolist(), self._atk.tolist(), self._def.tolist()))
+
+        # available actions indexed by (agent_state, opponent_state)
+        N = self.n_max_energy + 1
+        self._avail = np.zeros((N, N, self.n_max_actions), dtype=np.int8)
+        self._avail[:, :, 0] = 1
+        for s in range(N):
+            self._avail[s, :, 1:min(self.level, s) + 1] = 1
+            self._avail[:, s, self.level + 1:min(self.level, s) + self.level + 1] = 1
+        self._avail.setflags(write=False)
+
+        # transition table indexed by (agent_state, opponent_state, agent_action, opponent_action)
+        shape = (N, N, self.n_max_actions, self.n_max_actions)
+        next_s1, next_s2, game_state = self._step(*np.indices(shape))
+        self._next_s1 = next_s1.astype(np.int16)
+        self._next_s2 = next_s2.astype(np.int16)
+        self._game_state = game_state.astype(np.int8)
+        for table in (self._next_s1, self._next_s2, self._game_state):
+            table.setflags(write=False)
+
     def decode_action(self, action_id):
         if action_id is None:
             return 0, 0, 0
-        if action_id == 0:  # yun
-            return 1, 0, 0
-        elif action_id < self.level + 1:  # attack
-            return 0, action_id, 0
-        else:  # defense
-            return 0, 0, action_id - self.level
+        return self._decoded[action_id]
 
     def encode_action(self, yun, attack, defense):
         if yun:
@@ -34,11 +57,8 @@ class Rule(object):
             return defense + self.level
 
     def available_actions(self, s1, s2):
-        A = np.zeros(self.n_max_actions)
-        A[0] = 1
-        A[1:min(self.level, s1) + 1] = 1
-        A[self.level + 1:min(self.level, s2) + self.level + 1] = 1
-        return A
+        # read-only view, copy before modifying
+        return self._avail[s1, s2]
 
     def step(self, agent_state: int,
              opponent_state: int,
@@ -50,42 +70,37 @@ class Rule(object):
             opponent_next_state (left energy)
             game_next_state (0 continue 1 opponent win, 2 agent win)
         """
-        N = self.n_max_energy + 1  # state dimension
-        y1, a1, d1 = self.decode_action(agent_action)
-        y2, a2, d2 = self.decode_action(opponent_action)
+        index = agent_state, opponent_state, agent_action, opponent_action
+        return self._next_s1[index], self._next_s2[index], self._game_state[index]
+
+    def _step(self, agent_state, opponent_state, agent_action, opponent_action):
+        # game logic behind the transition table, elementwise over arrays
+        y1, a1, d1 = self._yun[agent_action], self._atk[agent_action], self._def[agent_action]
+        y2, a2, d2 = self._yun[opponent_action], self._atk[opponent_action], self._def[opponent_action]
 
         # handle states
-        agent_next_state = min(agent_state + y1 - a1, self.n_max_energy)
-        opponent_next_state = min(opponent_state + y2 - a2, self.n_max_energy)
-        if opponent_next_state < 0:
-            # game continues with this setup
-            opponent_next_state = 0
-            a2 = 0
-        game_next_state = 0
-
-        # punish invalid actions
-        if agent_next_state < 0:
-            agent_next_state = 0
-            game_next_state = 1
-            return agent_next_state, opponent_next_state, game_next_state
-
-        # punish stupid actions
-        if d1 > opponent_state:
-            game_next_state = 1
-            return agent_next_state, opponent_next_state, game_next_state
-
-        # handle result
-        if a1 and a1 > a2 and a1 != d2:  # agent win
-            game_next_state = 2
-        elif a2 and a2 > a1 and a2 != d1:  # agent loss
-            game_next_state = 1
+        agent_next_state = np.minimum(agent_state + y1 - a1, self.n_max_energy)
+        opponent_next_state = np.minimum(opponent_state + y2 - a2, self.n_max_energy)
+        # game continues with this setup if the opponent can't afford its attack
+        a2 = np.where(opponent_next_state < 0, 0, a2)
+        opponent_next_state = np.maximum(opponent_next_state, 0)
+
+        # punish invalid and stupid actions
+        punished = (agent_next_state < 0) | (d1 > opponent_state)
+        agent_next_state = np.maximum(agent_next_state, 0)
+
+        # handle result, win and loss are exclusive
+        win = (a1 > a2) & (a1 != d2) & (a1 > 0)
+        loss = (a2 > a1) & (a2 != d1) & (a2 > 0)
+        game_next_state = np.where(punished, 1, 2 * win + loss)
 
         return agent_next_state, opponent_next_state, game_next_state
 
+
 class YunEnv(gym.Env):
     metadata = {"render_modes": ["human"], "render_fps": 4}
 
-    def __init__(self, render_mode=None, rule=None, max_episode_steps=20):
+    def __init__(self, render_mode=None, rule=None, max_episode_steps=20, return_info=False):
         if rule is None:
             rule = Rule()
         self.rule = rule  # The rule or anything informative of the game
@@ -106,9 +121,14 @@ class YunEnv(gym.Env):
 
         assert render_mode is None or render_mode in self.metadata["render_modes"]
         self.render_mode = render_mode
+        # the info dict is only built on request or when rendering
+        self.return_info = return_info or render_mode is not None
 
         self.max_episode_steps = max_episode_steps
-        self.action_matrix = np.array([self.available_actions(s) for s in range(self.observation_space.n)])
+        # available actions per observation, terminal states allow every action
+        self.action_matrix = np.ones((self.observation_space.n, self.action_space.n), dtype=np.int8)
+        self.action_matrix[:self.N ** 2] = rule._avail.reshape(self.N ** 2, -1)
+        self.action_matrix.setflags(write=False)
 
     @staticmethod
     def convert_obs(S1, S2, rule):
@@ -121,10 +141,7 @@ class YunEnv(gym.Env):
         return (observation // n, observation % n)
 
     def available_actions(self, observation):
-        if observation < self.N ** 2:
-            return self.rule.available_actions(*YunEnv.convert_states(observation, self.rule))
-        else:
-            return np.ones(self.action_space.n)
+        return self.action_matrix[observation]
 
     def _get_obs(self):
         # agent's observation as a int
@@ -166,8 +183,7 @@ class YunEnv(gym.Env):
 
         # initialize players' energy
         if self.train:
-            self._agent_state = np.random.randint(0, self.N)
-            self._opponent_state = np.random.randint(0, self.N)
+            self._agent_state, self._opponent_state = self.np_random.integers(0, self.N, 2)
         else:
             self._agent_state = self.rule.init_energy
             self._opponent_state = self.rule.init_energy
@@ -177,9 +193,9 @@ class YunEnv(gym.Env):
         self._opponent_action = None
 
         observation = self._get_obs()
-        info = self._get_info()
+        info = self._get_info() if self.return_info else {}
         self._i_step = 0
-        self.obs_history=[]
+        self._visited = np.zeros(self.observation_space.n, dtype=np.uint8)
         if self.render_mode == "human":
             self._render_frame()
 
@@ -188,9 +204,10 @@ class YunEnv(gym.Env):
     def step(self, action):
         self._agent_action = action
         if self.opponent is not None:
-            self._opponent_action = self.opponent.step(self._oppo_obs(), Amask=self.available_actions(self._oppo_obs()))
+            oppo_obs = self._oppo_obs()
+            self._opponent_action = self.opponent.step(oppo_obs, Amask=self.action_matrix[oppo_obs])
         else:
-            self._opponent_action = self.action_space.sample()
+            self._opponent_action = int(self.np_random.integers(0, self.rule.n_max_actions))
         self._agent_state, self._opponent_state, self._game_state = self.rule.step(agent_state=self._agent_state,
                                                                                    opponent_state=self._opponent_state,
                                                                                    agent_action=action,
@@ -207,9 +224,9 @@ class YunEnv(gym.Env):
             reward = 0
 
         observation = self._get_obs()
-        info = self._get_info()
-        truncated = observation in self.obs_history # truncate if the state is visited
-        self.obs_history.append(observation)
+        info = self._get_info() if self.return_info else {}
+        truncated = bool(self._visited[observation])  # truncate if the state is visited
+        self._visited[observation] = 1
         if self.render_mode == "human":
             self._render_frame()
 
@@ -219,8 +236,50 @@ class YunEnv(gym.Env):
         return observation, reward, terminated, truncated, info
 
 
+def reference_step(rule, agent_state, opponent_state, agent_action, opponent_action):
+    # scalar game logic the Rule transition table must reproduce
+    def decode(action_id):
+        if action_id == 0:  # yun
+            return 1, 0, 0
+        elif action_id < rule.level + 1:  # attack
+            return 0, action_id, 0
+        else:  # defense
+            return 0, 0, action_id - rule.level
+
+    y1, a1, d1 = decode(agent_action)
+    y2, a2, d2 = decode(opponent_action)
+
+    agent_next_state = min(agent_state + y1 - a1, rule.n_max_energy)
+    opponent_next_state = min(opponent_state + y2 - a2, rule.n_max_energy)
+    if opponent_next_state < 0:
+        # game continues with this setup
+        opponent_next_state = 0
+        a2 = 0
+
+    # punish invalid actions
+    if agent_next_state < 0:
+        return 0, opponent_next_state, 1
+    # punish stupid actions
+    if d1 > opponent_state:
+        return agent_next_state, opponent_next_state, 1
+
+    if a1 and a1 > a2 and a1 != d2:  # agent win
+        return agent_next_state, opponent_next_state, 2
+    elif a2 and a2 > a1 and a2 != d1:  # agent loss
+        return agent_next_state, opponent_next_state, 1
+    return agent_next_state, opponent_next_state, 0
+
+
 def test():
-    env = YunEnv()
+    for n_max_energy, level in [(5, 3), (2, 2), (8, 4), (3, 1), (1, 3), (12, 5)]:
+        rule = Rule(n_max_energy=n_max_energy, level=level)
+        N = n_max_energy + 1
+        for s1, s2, a1, a2 in itertools.product(range(N), range(N), range(rule.n_max_actions),
+                                                range(rule.n_max_actions)):
+            assert tuple(int(v) for v in rule.step(s1, s2, a1, a2)) == reference_step(rule, s1, s2, a1, a2)
+    print("pass, Rule.step == reference_step")
+
+    env = YunEnv(return_info=True)
 
     print(env.observation_space.n)
     print(env.action_space.n)
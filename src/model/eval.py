@@ -7,9 +7,45 @@ from tqdm import tqdm
 import numpy as np
 from src.model.env import YunEnv, Rule
 from src.model.agent import Agent
+from src.model.rollout import build_cum, run_episodes_batch, run_episodes_vec, run_pair, seed as seed_rollout
 import argparse, time, itertools
+from concurrent.futures import ThreadPoolExecutor
 from scipy.linalg import schur
 
+
+def plot_state_grid(values, title, cmap="Reds", image=None):
+    # heatmap over (S1, S2) annotated with values, image defaults to values
+    ns = values.shape[0]
+    fig, ax = plt.subplots(figsize=(6, 6))
+    ax.imshow(values if image is None else image, cmap=cmap)
+    ax.set_title(title)
+    ax.set_xticks(np.arange(ns), np.arange(ns))
+    ax.set_xlabel("S2")
+    ax.set_yticks(np.arange(ns), np.arange(ns))
+    ax.set_ylabel("S1")
+    for (i, j), v in np.ndenumerate(values):
+        ax.text(j, i, f"{v:.2f}", ha="center", va="center", color="w")
+    fig.tight_layout()
+    return fig, ax
+
+
+def plot_state_stats(ns, state_freq, win_last_state_freq, state_value_sum, state_value_cnt,
+                     win_title="Winner last state frequency"):
+    # state visit
+    state_freq = state_freq[:ns ** 2] / state_freq.sum()
+    plot_state_grid(state_freq.reshape(ns, ns), "State visit frequency")
+
+    # winner last state
+    win_last_state_freq = win_last_state_freq[:ns ** 2] / win_last_state_freq.sum()
+    plot_state_grid(win_last_state_freq.reshape(ns, ns), win_title)
+
+    # V(s)
+    state_value = np.divide(state_value_sum, state_value_cnt, out=np.zeros_like(state_value_sum),
+                            where=state_value_cnt > 0)
+    state_value = state_value[:ns ** 2].reshape(ns, ns)
+    plot_state_grid(state_value, "State-value V(s) @ varying states", cmap="RdBu_r", image=-state_value)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--model_file', type=str, help="filename of the model", default="Qh.npy")
@@ -22,6 +58,12 @@ if __name__ == "__main__":
     parser.add_argument('--selfplay', action='store_true', help="run self play")
     parser.add_argument('--Smax', type=int, help="max energy level of the game", default=5)
     parser.add_argument('--Amax', type=int, help="max attack level of the game", default=3)
+    parser.add_argument('--backend', type=str, choices=['numba', 'numpy'], help="rollout backend for --tour and --selfplay",
+                        default='numba')
+    parser.add_argument('--plot', action=argparse.BooleanOptionalAction, help="plot the results of --tour and --selfplay",
+                        default=True)
+    parser.add_argument('--workers', type=int, help="number of worker threads for --tour",
+                        default=None)
 
 
     args = parser.parse_args()
@@ -30,15 +72,19 @@ if __name__ == "__main__":
     else:
         seed = int(time.time())
     np.random.seed(seed)
+    seed_rollout(seed)
     print("running with seed", seed)
 
     rule = Rule(n_max_energy=args.Smax, level=args.Amax, init_energy=1)
 
-    env = YunEnv(rule=rule)
+    env = YunEnv(rule=rule, return_info=args.run)
+    env.reset(seed=seed)
+    run_episodes = run_episodes_batch if args.backend == 'numba' else run_episodes_vec
 
     model = np.load(args.model_file,allow_pickle=True).item()
-    nash = model.get('nash')
-    Pi = model.get('pi')
+    # policies are read row by row in the rollouts, keep them compact and contiguous
+    nash = np.ascontiguousarray(model.get('nash'), dtype=np.float32)
+    Pi = np.ascontiguousarray(model.get('pi'), dtype=np.float32)
     print("model loaded from {}, size {}".format(args.model_file, Pi.shape))
 
     if args.run:
@@ -103,205 +149,100 @@ if __name__ == "__main__":
         NP = pi.shape[0]
         R = np.zeros([NP, NP])
         ns = env.rule.n_max_energy + 1
-        state_freq = np.zeros(env.observation_space.n)
-        state_value = [list() for i in range(env.observation_space.n)]
-        win_last_state_freq = np.zeros(env.observation_space.n)
+        state_freq = np.zeros(env.observation_space.n, dtype=np.int64)
+        state_value_sum = np.zeros(env.observation_space.n)
+        state_value_cnt = np.zeros(env.observation_space.n, dtype=np.int64)
+        win_last_state_freq = np.zeros(env.observation_space.n, dtype=np.int64)
         tot_matches = num_matches_per_pair * (1 + NP) * NP / 2
+        cum = build_cum(pi, env.action_matrix)
         print("running tournament, total matches: {}".format(tot_matches))
 
-        for i in tqdm(range(NP), position=0):
-            for j in tqdm(range(NP), position=1, leave=False):
-                if j < i:
-                    R[i, j] = -R[j, i]
-                    continue
-                for k in range(num_matches_per_pair):
-                    P1 = Agent(pi[i], mode='prob')
-                    P2 = Agent(pi[j], mode='prob')
-
-                    observation, info = env.reset(opponent=P2, train=random_start)
-                    Lt = [info]
-                    for t in range(max_steps):
-                        action = P1.step(observation, Amask=env.available_actions(observation))
-                        observation, reward, terminated, truncated, info = env.step(action)
-                        Lt.append(info)
-                        state_freq[observation] += 1
-                        if terminated:
-                            R[i, j] += reward
-                            obs_set = set([inf["observation"] for inf in Lt])
-                            for obs in obs_set:
-                                state_value[obs] += [reward]
-                            if reward == 1:
-                                win_last_state_freq[Lt[-2]["observation"]] += 1
-                            break
-                        if truncated:
-                            break
+        if args.backend == 'numba':
+            # pairs are independent, play them in parallel
+            I, J = np.triu_indices(NP)
+            seeds = np.random.randint(0, 2 ** 31, len(I))
+            with ThreadPoolExecutor(args.workers) as pool:
+                const = itertools.repeat
+                results = pool.map(run_pair, cum[I], cum[J], const(num_matches_per_pair),
+                                   const(min(max_steps, env.max_episode_steps)), const(rule), const(random_start),
+                                   seeds)
+                for i, j, (r, sf, wl, vs, vc) in tqdm(zip(I, J, results), total=len(I)):
+                    R[j, i] = -r
+                    R[i, j] = r
+                    state_freq += sf
+                    win_last_state_freq += wl
+                    state_value_sum += vs
+                    state_value_cnt += vc
+        else:
+            # all pairs in one batch
+            I, J = np.triu_indices(NP)
+            rewards, _, _ = run_episodes(cum, cum, len(I) * num_matches_per_pair,
+                                         min(max_steps, env.max_episode_steps), rule, random_start,
+                                         state_freq, win_last_state_freq,
+                                         state_value_sum, state_value_cnt,
+                                         agent_ids=np.repeat(I, num_matches_per_pair),
+                                         opponent_ids=np.repeat(J, num_matches_per_pair))
+            rewards = rewards.reshape(-1, num_matches_per_pair).sum(1)
+            R[J, I] = -rewards
+            R[I, J] = rewards
 
         R /= num_matches_per_pair
         tot = R.sum(1, keepdims=True) / NP
 
-        # schur decomp
-        fig, ax = plt.subplots(figsize=(6, 6))
-        T, Z = schur(R, output='complex')
-        cm = plt.get_cmap("RdBu_r")
-        ax.set_title("First 2 components by Schur decomposition")
-        col = (tot.max() - tot) / (tot.max() - tot.min())
-        ax.scatter(Z.real[:, 0], Z.real[:, 1], marker='o', c=cm([int(c * 255) for c in col]))
-        fig.tight_layout()
+        print("average score of each model:", np.round(tot[:, 0], 3))
 
-        # evaluation matrix
+        if args.plot:
+            # schur decomp
+            fig, ax = plt.subplots(figsize=(6, 6))
+            T, Z = schur(R, output='real', check_finite=False)
+            cm = plt.get_cmap("RdBu_r")
+            ax.set_title("First 2 components by Schur decomposition")
+            col = (tot.max() - tot) / (tot.max() - tot.min())
+            ax.scatter(Z[:, 0], Z[:, 1], marker='o', c=cm([int(c * 255) for c in col]))
+            fig.tight_layout()
 
-        fig, ax = plt.subplots(figsize=(8, 8))
-        im = ax.imshow(-R, cmap="RdBu_r")
-        ax.set_title("Evaluation matrix")
+            # evaluation matrix
 
-        ax.set_xticklabels([])
-        ax.set_yticklabels([])
-
-        fig.tight_layout()
+            fig, ax = plt.subplots(figsize=(8, 8))
+            im = ax.imshow(-R, cmap="RdBu_r")
+            ax.set_title("Evaluation matrix")
 
-        # state visit
-        state_freq = state_freq[:ns ** 2] / state_freq.sum()
-        state_freq = state_freq.reshape(ns, ns)
-
-        fig, ax = plt.subplots(figsize=(6, 6))
-        im = ax.imshow(state_freq, cmap="Reds")
-        ax.set_title("State visit frequency")
-        ax.set_xticks(np.arange(ns), np.arange(ns))
-        ax.set_xlabel("S2")
-        ax.set_yticks(np.arange(ns), np.arange(ns))
-        ax.set_ylabel("S1")
-        for i in range(ns):
-            for j in range(ns):
-                text = ax.text(j, i, round(state_freq[i, j], 2),
-                               ha="center", va="center", color="w")
-        fig.tight_layout()
+            ax.set_xticklabels([])
+            ax.set_yticklabels([])
 
-        # winner last state
-        win_last_state_freq = win_last_state_freq[:ns ** 2] / win_last_state_freq.sum()
-        win_last_state_freq = win_last_state_freq.reshape(ns, ns)
-
-        fig, ax = plt.subplots(figsize=(6, 6))
-        im = ax.imshow(win_last_state_freq, cmap="Reds")
-        ax.set_title("Winner last state frequency")
-        ax.set_xticks(np.arange(ns), np.arange(ns))
-        ax.set_xlabel("S2")
-        ax.set_yticks(np.arange(ns), np.arange(ns))
-        ax.set_ylabel("S1")
-        for i in range(ns):
-            for j in range(ns):
-                text = ax.text(j, i, round(win_last_state_freq[i, j], 2),
-                               ha="center", va="center", color="w")
-        fig.tight_layout()
+            fig.tight_layout()
 
-        # V(s)
-        state_value = np.array([np.mean(r) if len(r) > 0 else 0 for r in state_value])
-        state_value = state_value[:ns ** 2]
-        state_value = state_value.reshape(ns, ns)
-        fig, ax = plt.subplots(figsize=(6, 6))
-        im = ax.imshow(-state_value, cmap="RdBu_r")
-        ax.set_title("State-value V(s) @ varying states")
-        ax.set_xticks(np.arange(ns), np.arange(ns))
-        ax.set_xlabel("S2")
-        ax.set_yticks(np.arange(ns), np.arange(ns))
-        ax.set_ylabel("S1")
-        for i in range(ns):
-            for j in range(ns):
-                text = ax.text(j, i, round(state_value[i, j], 2),
-                               ha="center", va="center", color="w")
-        fig.tight_layout()
+            plot_state_stats(ns, state_freq, win_last_state_freq, state_value_sum, state_value_cnt)
 
-        # stats
-        plt.show()
+            # stats
+            plt.show()
 
     if args.selfplay:
         N = 100000
         print(f"running selfplay (custom vs nash) {int(N)} times")
         custom_pi = np.copy(nash)
         custom_pi[7]=np.array([1,0,0,0,0,0,0])
-        P1 = Agent(custom_pi, mode='prob')
-        P2 = Agent(nash, mode='prob')
-        rewards = []
-        length = []
         ns = env.rule.n_max_energy + 1
-        state_freq = np.zeros(env.observation_space.n)
-        state_value = [list() for i in range(env.observation_space.n)]
-        win_last_state_freq = np.zeros(env.observation_space.n)
-        for i in tqdm(range(int(N))):
-            observation, info = env.reset(opponent=P2, train=args.r)
-            Lt = [info]
-            for t in itertools.count():
-                action = P1.step(observation, env.action_space.n)
-                observation, reward, terminated, truncated, info = env.step(action)
-                Lt.append(info)
-                state_freq[observation] += 1
-                if terminated:
-                    rewards += [reward]
-                    length += [env._i_step]
-                    obs_set = set([inf["observation"] for inf in Lt])
-                    for obs in obs_set:
-                        state_value[obs] += [reward]
-                    if reward == 1:
-                        win_last_state_freq[Lt[-2]["observation"]] += 1
-                    break
-                if truncated:
-                    length += [env._i_step]
-                    break
-
-        # state visit
-        state_freq = state_freq[:ns ** 2] / state_freq.sum()
-        state_freq = state_freq.reshape(ns, ns)
-
-        fig, ax = plt.subplots(figsize=(6, 6))
-        im = ax.imshow(state_freq, cmap="Reds")
-        ax.set_title("State visit frequency")
-        ax.set_xticks(np.arange(ns), np.arange(ns))
-        ax.set_xlabel("S2")
-        ax.set_yticks(np.arange(ns), np.arange(ns))
-        ax.set_ylabel("S1")
-        for i in range(ns):
-            for j in range(ns):
-                text = ax.text(j, i, round(state_freq[i, j], 2),
-                               ha="center", va="center", color="w")
-        fig.tight_layout()
+        state_freq = np.zeros(env.observation_space.n, dtype=np.int64)
+        state_value_sum = np.zeros(env.observation_space.n)
+        state_value_cnt = np.zeros(env.observation_space.n, dtype=np.int64)
+        win_last_state_freq = np.zeros(env.observation_space.n, dtype=np.int64)
+        # P1 plays without an action mask
+        cum1 = build_cum(custom_pi, np.ones_like(env.action_matrix))
+        cum2 = build_cum(nash, env.action_matrix)
+        rewards, length, terminated = run_episodes(cum1, cum2, int(N), env.max_episode_steps, rule, args.r,
+                                                   state_freq, win_last_state_freq,
+                                                   state_value_sum, state_value_cnt)
+        rewards = rewards[terminated]
+
+        if args.plot:
+            plot_state_stats(ns, state_freq, win_last_state_freq, state_value_sum, state_value_cnt,
+                             win_title="P1 Winning state frequency")
 
-        # winner last state
-        win_last_state_freq = win_last_state_freq[:ns ** 2] / win_last_state_freq.sum()
-        win_last_state_freq = win_last_state_freq.reshape(ns, ns)
-
-        fig, ax = plt.subplots(figsize=(6, 6))
-        im = ax.imshow(win_last_state_freq, cmap="Reds")
-        ax.set_title("P1 Winning state frequency")
-        ax.set_xticks(np.arange(ns), np.arange(ns))
-        ax.set_xlabel("S2")
-        ax.set_yticks(np.arange(ns), np.arange(ns))
-        ax.set_ylabel("S1")
-        for i in range(ns):
-            for j in range(ns):
-                text = ax.text(j, i, round(win_last_state_freq[i, j], 2),
-                               ha="center", va="center", color="w")
-        fig.tight_layout()
-
-        # V(s)
-        state_value = np.array([np.average(r) for r in state_value])
-        state_value = state_value[:ns ** 2]
-        state_value = state_value.reshape(ns, ns)
-        fig, ax = plt.subplots(figsize=(6, 6))
-        im = ax.imshow(-state_value, cmap="RdBu_r")
-        ax.set_title("State-value V(s) @ varying states")
-        ax.set_xticks(np.arange(ns), np.arange(ns))
-        ax.set_xlabel("S2")
-        ax.set_yticks(np.arange(ns), np.arange(ns))
-        ax.set_ylabel("S1")
-        for i in range(ns):
-            for j in range(ns):
-                text = ax.text(j, i, round(state_value[i, j], 2),
-                               ha="center", va="center", color="w")
-        fig.tight_layout()
-
-        rewards = np.array(rewards)
         win = rewards[rewards > 0].shape[0]
         print(f"total match finished within {env.max_episode_steps} steps: {len(rewards)}")
         print(f"win/loss={win}/{len(rewards)-win}")
         print(f"mean length = {np.average(length)} +- {np.std(length)/np.sqrt(len(length))}")
         print(f"mean reward = {np.average(rewards)} +- {np.std(rewards)/np.sqrt(len(rewards))}")
-        plt.show()
+        if args.plot:
+            plt.show()
@@ -0,0 +1,302 @@
+"""
+Batched episode rollouts for fast evaluation
+rlsn 2024
+"""
+import numpy as np
+import itertools
+from numba import njit  ### pip install numba
+
+
+@njit(cache=True, nogil=True)
+def seed(s):
+    # numba keeps its own random state, separate from np.random
+    np.random.seed(s)
+
+
+def build_cum(pi, mask):
+    """
+    cumulative distribution of each policy row restricted to the available actions,
+    for sampling the same way as Agent.step in 'prob' mode
+    rows without probability mass on the available actions become uniform over them
+    """
+    p = np.asarray(pi, dtype=np.float64) * mask
+    if (p < 0).any():
+        raise Exception(f"probabilities are not non-negative\n p={p[(p < 0).any(-1)]}")
+    tot = p.sum(-1, keepdims=True)
+    p = np.where(tot > 0, p / np.where(tot > 0, tot, 1), mask / mask.sum(-1, keepdims=True))
+    cum = np.cumsum(p, axis=-1)
+    # pin the tail to 1 so that any u in [0, 1) lands on an action with probability mass
+    cum = np.where(cum >= cum[..., -1:], 1., cum)
+    return np.ascontiguousarray(cum, dtype=np.float32)
+
+
+@njit(cache=True, nogil=True)
+def agent_step(cum_row):
+    """
+    sample an action from a row of build_cum
+    """
+    return np.searchsorted(cum_row, np.random.random(), side='right')
+
+
+@njit(cache=True, nogil=True)
+def run_episode(cum1, cum2, max_steps, init_energy, next_s1, next_s2, next_game_state,
+                random_start, obs_buf, visited):
+    """
+    play one episode of cum1 (agent) against cum2 (opponent), following YunEnv
+    obs_buf receives the observations, starting with the initial one
+    return:
+        number of steps taken
+        final game state (0 truncated, 1 agent loss, 2 agent win)
+    """
+    N = next_s1.shape[0]
+    if random_start:
+        s1 = np.random.randint(0, N)
+        s2 = np.random.randint(0, N)
+    else:
+        s1 = init_energy
+        s2 = init_energy
+    visited[:] = False
+    obs_buf[0] = s1 * N + s2
+    for t in range(max_steps):
+        a1 = agent_step(cum1[s1 * N + s2])
+        a2 = agent_step(cum2[s2 * N + s1])
+        game_state = next_game_state[s1, s2, a1, a2]
+        s1, s2 = next_s1[s1, s2, a1, a2], next_s2[s1, s2, a1, a2]
+        if game_state == 1:
+            obs_buf[t + 1] = N * N
+            return t + 1, game_state
+        elif game_state == 2:
+            obs_buf[t + 1] = N * N + 1
+            return t + 1, game_state
+        observation = s1 * N + s2
+        obs_buf[t + 1] = observation
+        if visited[observation]:  # truncate if the state is visited
+            return t + 1, 0
+        visited[observation] = True
+    return max_steps, 0
+
+
+def run_episodes_batch(cum1, cum2, num_episodes, max_steps, rule, random_start,
+                       state_freq, win_last_state_freq, state_value_sum, state_value_cnt):
+    """
+    play num_episodes episodes of cum1 against cum2 (see build_cum), accumulating the visit statistics in place
+    return:
+        rewards of the agent (0 if truncated)
+        episode lengths
+        whether each episode terminated
+    """
+    return _run_episodes_batch(cum1, cum2, num_episodes, max_steps, rule.init_energy,
+                               rule._next_s1, rule._next_s2, rule._game_state, random_start,
+                               state_freq, win_last_state_freq, state_value_sum, state_value_cnt)
+
+
+@njit(cache=True, nogil=True)
+def _run_episodes_batch(cum1, cum2, num_episodes, max_steps, init_energy,
+                        next_s1, next_s2, next_game_state, random_start,
+                        state_freq, win_last_state_freq, state_value_sum, state_value_cnt):
+    S = state_freq.shape[0]
+    rewards = np.zeros(num_episodes, np.int8)
+    lengths = np.zeros(num_episodes, np.int32)
+    terminated = np.zeros(num_episodes, np.bool_)
+    obs_buf = np.empty(max_steps + 1, np.int32)
+    visited = np.zeros(S, np.bool_)
+    credited = np.zeros(S, np.bool_)
+    for k in range(num_episodes):
+        t, game_state = run_episode(cum1, cum2, max_steps, init_energy, next_s1, next_s2, next_game_state,
+                                    random_start, obs_buf, visited)
+        lengths[k] = t
+        for i in range(1, t + 1):
+            state_freq[obs_buf[i]] += 1
+        if game_state == 0:
+            continue
+        reward = 1 if game_state == 2 else -1
+        rewards[k] = reward
+        terminated[k] = True
+        credited[:] = False
+        for i in range(t + 1):
+            obs = obs_buf[i]
+            if not credited[obs]:
+                credited[obs] = True
+                state_value_sum[obs] += reward
+                state_value_cnt[obs] += 1
+        if reward == 1:
+            win_last_state_freq[obs_buf[t - 1]] += 1
+    return rewards, lengths, terminated
+
+
+def run_pair(cum1, cum2, num_episodes, max_steps, rule, random_start, random_seed):
+    """
+    run_episodes_batch with its own statistics and seed, to be run in a worker thread
+    return:
+        total reward of the agent
+        state_freq, win_last_state_freq, state_value_sum, state_value_cnt
+    """
+    seed(random_seed)
+    S = cum1.shape[0]
+    state_freq = np.zeros(S, dtype=np.int64)
+    win_last_state_freq = np.zeros(S, dtype=np.int64)
+    state_value_sum = np.zeros(S)
+    state_value_cnt = np.zeros(S, dtype=np.int64)
+    rewards, _, _ = run_episodes_batch(cum1, cum2, num_episodes, max_steps, rule, random_start,
+                                       state_freq, win_last_state_freq, state_value_sum, state_value_cnt)
+    return rewards.sum(), state_freq, win_last_state_freq, state_value_sum, state_value_cnt
+
+
+def agent_step_vec(cum, obs, ids):
+    """
+    sample one action per row of obs from the stacked tables of build_cum cum[ids]
+    """
+    u = np.random.random((len(obs), 1))
+    return (u < cum[ids, obs]).argmax(1)
+
+
+def run_episodes_vec(cum1, cum2, num_episodes, max_steps, rule, random_start,
+                     state_freq, win_last_state_freq, state_value_sum, state_value_cnt,
+                     agent_ids=None, opponent_ids=None):
+    """
+    numpy counterpart of run_episodes_batch, playing all episodes side by side
+    if agent_ids and opponent_ids are given, cum1 and cum2 are stacks of tables and
+    episode k plays cum1[agent_ids[k]] against cum2[opponent_ids[k]]
+    """
+    N = rule.n_max_energy + 1
+    S = state_freq.shape[0]
+    B = num_episodes
+    if agent_ids is None:
+        cum1, cum2 = cum1[None], cum2[None]
+        agent_ids = opponent_ids = np.zeros(B, dtype=int)
+    if random_start:
+        s1 = np.random.randint(0, N, B)
+        s2 = np.random.randint(0, N, B)
+    else:
+        s1 = np.full(B, rule.init_energy)
+        s2 = np.full(B, rule.init_energy)
+    obs_buf = np.zeros([B, max_steps + 1], dtype=np.int32)
+    obs_buf[:, 0] = s1 * N + s2
+    visited = np.zeros([B, S], dtype=bool)
+    rewards = np.zeros(B, np.int8)
+    lengths = np.full(B, max_steps, np.int32)
+    terminated = np.zeros(B, dtype=bool)
+
+    live = np.arange(B)
+    for t in range(max_steps):
+        a1 = agent_step_vec(cum1, s1 * N + s2, agent_ids[live])
+        a2 = agent_step_vec(cum2, s2 * N + s1, opponent_ids[live])
+        index = s1, s2, a1, a2
+        # widen the int16 table entries before computing observations
+        s1, s2 = rule._next_s1[index].astype(np.intp), rule._next_s2[index].astype(np.intp)
+        game_state = rule._game_state[index]
+        observation = np.where(game_state == 0, s1 * N + s2, np.where(game_state == 1, N ** 2, N ** 2 + 1))
+        obs_buf[live, t + 1] = observation
+
+        done = game_state > 0
+        rewards[live[done]] = np.where(game_state[done] == 2, 1, -1)
+        terminated[live[done]] = True
+        # truncate if the state is visited
+        done |= visited[live, observation]
+        visited[live, observation] = True
+        lengths[live[done]] = t + 1
+
+        keep = ~done
+        live, s1, s2 = live[keep], s1[keep], s2[keep]
+        if len(live) == 0:
+            break
+
+    # statistics
+    steps = np.arange(max_steps + 1)
+    in_episode = steps <= lengths[:, None]
+    np.add.at(state_freq, obs_buf[:, 1:][in_episode[:, 1:]], 1)
+
+    seen = np.zeros([B, S], dtype=bool)
+    rows, cols = np.nonzero(in_episode)
+    seen[rows, obs_buf[rows, cols]] = True
+    seen = seen[terminated]
+    state_value_sum += (seen * rewards[terminated, None]).sum(0)
+    state_value_cnt += seen.sum(0)
+
+    won = np.flatnonzero(rewards == 1)
+    np.add.at(win_last_state_freq, obs_buf[won, lengths[won] - 1], 1)
+    return rewards, lengths, terminated
+
+
+def test():
+    from src.model.env import YunEnv, Rule
+    from src.model.agent import Agent
+
+    def new_stats(S):
+        return np.zeros(S, np.int64), np.zeros(S, np.int64), np.zeros(S), np.zeros(S, np.int64)
+
+    rule = Rule()
+    env = YunEnv(rule=rule)
+    S, nA = env.observation_space.n, env.action_space.n
+    pi1, pi2 = np.random.rand(2, S, nA)
+    cum1, cum2 = build_cum(pi1, env.action_matrix), build_cum(pi2, env.action_matrix)
+
+    # the kernel reproduces the YunEnv + Agent loop exactly given the same random stream
+    N = 2000
+    np.random.seed(0)
+    seed(0)
+    P1, P2 = Agent(pi1), Agent(pi2)
+    stats = new_stats(S)
+    rewards, lengths, terminated = [], [], []
+    for k in range(N):
+        observation, info = env.reset(opponent=P2, train=False)
+        obs_list = [observation]
+        for t in itertools.count():
+            action = P1.step(observation, Amask=env.available_actions(observation))
+            observation, reward, term, trunc, info = env.step(action)
+            obs_list.append(observation)
+            stats[0][observation] += 1
+            if term:
+                for obs in set(obs_list):
+                    stats[2][obs] += reward
+                    stats[3][obs] += 1
+                if reward == 1:
+                    stats[1][obs_list[-2]] += 1
+            if term or trunc:
+                rewards.append(reward if term else 0)
+                lengths.append(env._i_step)
+                terminated.append(term)
+                break
+    fast_stats = new_stats(S)
+    out = run_episodes_batch(cum1, cum2, N, env.max_episode_steps, rule, False, *fast_stats)
+    for x, y in zip((rewards, lengths, terminated) + stats, out + fast_stats):
+        assert np.array_equal(x, y)
+    print("pass, run_episodes_batch == YunEnv")
+
+    # the numpy backend agrees statistically
+    N = 100000
+    for random_start in (False, True):
+        stats, vec_stats = new_stats(S), new_stats(S)
+        r1, l1, _ = run_episodes_batch(cum1, cum2, N, env.max_episode_steps, rule, random_start, *stats)
+        r2, l2, _ = run_episodes_vec(cum1, cum2, N, env.max_episode_steps, rule, random_start, *vec_stats)
+        assert abs(r1.mean() - r2.mean()) < 5 * np.sqrt(2 / N)
+        assert abs(l1.mean() - l2.mean()) < 5 * np.sqrt(2 * l1.var() / N)
+        assert np.abs(stats[0] / stats[0].sum() - vec_stats[0] / vec_stats[0].sum()).max() < 0.01
+    print("pass, run_episodes_vec ~ run_episodes_batch")
+
+    # deterministic policies give identical statistics, also with observations beyond int16
+    rule = Rule(n_max_energy=200, level=1)
+    S = (rule.n_max_energy + 1) ** 2 + 2
+    yun = np.zeros([S, rule.n_max_actions])
+    yun[:, 0] = 1
+    cum = build_cum(yun, np.ones_like(yun))
+    stats, vec_stats = new_stats(S), new_stats(S)
+    run_episodes_batch(cum, cum, 10, 300, rule, False, *stats)
+    run_episodes_vec(cum, cum, 10, 300, rule, False, *vec_stats)
+    for x, y in zip(stats, vec_stats):
+        assert np.array_equal(x, y)
+    print("pass, run_episodes_vec == run_episodes_batch")
+
+    # negative probabilities are rejected like in Agent.step
+    bad = yun.copy()
+    bad[0, :2] = -1, 2
+    try:
+        build_cum(bad, np.ones_like(bad))
+    except Exception:
+        print("pass, build_cum rejects negative probabilities")
+    else:
+        raise AssertionError("build_cum accepted negative probabilities")
+
+
+if __name__ == "__main__":
+    test()
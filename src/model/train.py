@@ -29,7 +29,7 @@ def estimate_reward(env, num_episodes, p1, p2):
     for i in range(num_episodes):
         state, info = env.reset(opponent=p2, train=True)
         for t in itertools.count():
-            action = p1.step(state, Amask=env.available_actions(state))
+            action = p1.step(state, Amask=env.action_matrix[state])
             state, r, terminated, truncated, _ = env.step(action)
             if terminated or truncated:
                 R += r
@@ -40,18 +40,19 @@ def exploitability_nash(env,nash_pi,pi,Ne=300):
     R = 0
     nash_agent = Agent(nash_pi)
     for i in tqdm(range(pi.shape[0]), desc="Computing exploitability", position=1, leave=False):
-        R += max(estimate_reward(env, Ne, Agent(pi[i]), Agent(nash_pi)), 0)
+        R += max(estimate_reward(env, Ne, Agent(pi[i]), nash_agent), 0)
     return R / pi.shape[0]
 
 
 def gamescape(env, pi, Ne):
     R = np.zeros([len(pi), len(pi)])
+    agents = [Agent(p) for p in pi]
     for i in tqdm(range(len((pi))), desc="Computing gamescape", position=1, leave=False):
         for j in range(len(pi)):
             if j <= i:
                 R[i, j] = -R[j, i]
                 continue
-            R[i, j] = estimate_reward(env, Ne, Agent(pi[i]), Agent(pi[j]))
+            R[i, j] = estimate_reward(env, Ne, agents[i], agents[j])
     return R
 
 def PSRO_Q(env, num_iters=1000, num_steps_per_iter = 10000, eps=0.1, alpha=0.1, save_interval=1, evaluation_episodes=10):
@@ -130,6 +131,7 @@ if __name__ == "__main__":
 
     rule = Rule(n_max_energy=args.Smax, level=args.Amax, init_energy=1)
     env = YunEnv(rule=rule)
+    env.reset(seed=args.seed)
 
     print("args:", args)
 